@@ -5,10 +5,45 @@ from sklearn.metrics import mean_squared_error
 import numpy as np
 import sys
 import scipy
-from scipy.stats import multivariate_normal
 from scipy.optimize import minimize
+from scipy.linalg import cho_factor, cho_solve, cholesky, solve_triangular
 import matplotlib.pyplot as plt
 from dp4gp.utils import compute_Xtest, dp_unnormalise
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def _findLambdas_grad(C,ls,lr,maxit,tol):
+    """
+    The gradient descent loop of DPGP_cloaking.findLambdas_grad, written so that
+    numba can compile it (if it's installed). Uses the same gradient as
+    DPGP_cloaking.dL_dl.
+
+    Returns the lambdas, number of iterations and whether it converged.
+    """
+    jitter = 1e-10*np.eye(C.shape[0]) #as DPGP_cloaking.Mjitter
+    for it in range(maxit):
+        M = np.dot(C*ls,C.T) + jitter
+        MinvC = np.linalg.solve(M,C)
+        newls = ls - (1-np.sum(C*MinvC,0))*lr
+        newls[newls<0] = 0
+        if np.max(np.abs(ls-newls))<tol:
+            return newls, it, True
+        ls = newls
+    return ls, maxit, False
+
+if numba is not None:
+    _findLambdas_grad = numba.njit(cache=True)(_findLambdas_grad)
+
+def _draw_mvn_samples(cov,N):
+    """
+    Draw N samples from a zero mean multivariate normal with covariance cov, using its
+    Cholesky factor (jitchol adds jitter if cov is only numerically positive semi-definite).
+    Returns an N x len(cov) array, as np.random.multivariate_normal does.
+    """
+    L = GPy.util.linalg.jitchol(cov)
+    return np.dot(L,np.random.standard_normal((len(cov),N))).T
 
 class DPGP(object):
     """(epsilon,delta)-Differentially Private Gaussian Process predictions"""
@@ -26,13 +61,110 @@ class DPGP(object):
         self.sens = sens
         self.epsilon = epsilon
         self.delta = delta
+        #the noise scale common to the Gaussian mechanisms, sens*sqrt(2 log(2/delta))/epsilon
+        self._dp_const = self.sens*np.sqrt(2*np.log(2/self.delta))/self.epsilon
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """
+        Discard the cached kernel matrices and factorisation of the training covariance.
+        Changes to the model's hyperparameters and inducing inputs, and new training data
+        (e.g. from set_XY or set_Y), are detected automatically, but this needs calling
+        if model.X or model.Y is modified in place.
+        """
+        self._cache_state = None
+        self._L = None
+        self._alpha = None
+        self._kernel_cache_state = None
+        self._kernel_cache = {}
+
+    def _model_state(self):
+        """
+        The state of the model the caches are computed from: its parameters (the
+        hyperparameters and any inducing inputs) and its training data. The data is
+        held by reference, as GPy replaces (rather than modifies) it in set_XY.
+        """
+        return (self.model.param_array.tobytes(), self.model.X, self.model.Y)
+
+    def _is_current(self,state):
+        """
+        Whether state (from _model_state) still describes the model
+        """
+        return (state is not None and state[1] is self.model.X and state[2] is self.model.Y
+                and state[0]==self.model.param_array.tobytes())
+
+    def _input_name(self,A):
+        if A is self.model.X: return 'X'
+        if A is getattr(self.model,'Z',None): return 'Z'
+        return None
+
+    def _K(self,X1,X2=None):
+        """
+        Returns self.model.kern.K(X1,X2), memoising K_NM and K_MM (i.e. when X1 and X2 are
+        the model's training (model.X) or inducing (model.Z) inputs, and at least one is Z),
+        as these are needed again by every sparse prediction. GPy's own cache doesn't help
+        here: it is keyed on the input objects, and model.Z.values is a new view each time.
+        The kernel is evaluated on Z's values, and a read-only copy is kept, as GPy's FITC
+        inference adds jitter in place to arrays returned from its cache.
+        """
+        names = (self._input_name(X1), self._input_name(X1 if X2 is None else X2))
+        if None in names or 'Z' not in names:
+            return self.model.kern.K(X1,X2)
+        if not self._is_current(self._kernel_cache_state):
+            self._kernel_cache = {}
+            self._kernel_cache_state = self._model_state()
+        if names not in self._kernel_cache:
+            values = lambda A: A.values if A is self.model.Z else A
+            K = np.array(self.model.kern.K(values(X1),None if X2 is None else values(X2)))
+            K.setflags(write=False)
+            self._kernel_cache[names] = K
+        return self._kernel_cache[names]
+
+    def update_cache(self):
+        """
+        Compute (if the model has changed since last time) the Cholesky
+        factor, _L, of (K_NN + sigma^2 I) and _alpha = (K_NN + sigma^2 I)^-1 y
+        """
+        if self._is_current(self._cache_state):
+            return
+        sigmasqr = self.model.Gaussian_noise.variance[0]
+        K_NN = self.model.kern.K(self.model.X)
+        self._L = cho_factor(K_NN+sigmasqr*np.eye(K_NN.shape[0]))
+        self._alpha = cho_solve(self._L,self.model.Y)
+        self._cache_state = self._model_state()
     
+    def calc_fitc_terms(self):
+        """
+        For the sparse (FITC) methods, find Q^-1 K_NM^T and the diagonal of
+        (Lambda + sigma^2 I)^-1, where Q = K_MM + K_NM^T (Lambda + sigma^2 I)^-1 K_NM
+        """
+        sigmasqr = self.model.Gaussian_noise.variance[0]
+        K_NN_diags = self.model.kern.Kdiag(self.model.X)
+        
+        K_NM = self._K(self.model.X,self.model.Z)
+        K_MM = self._K(self.model.Z)
+        L_MM = GPy.util.linalg.jitchol(K_MM)
+        
+        #lambda values are the diagonal of the training input covariances minus 
+        #(cov of training+pseudo).(inv cov of pseudo).(transpose of cov of training+pseudo)
+        #the latter term is found for all training points at once as the column sums of V^2,
+        #where V = L_MM^-1 K_NM^T
+        V = solve_triangular(L_MM,K_NM.T,lower=True)
+        lamb = K_NN_diags - np.sum(V**2,0)
+
+        #this finds (\Lambda + \sigma^2 I)^{-1}
+        diag = 1.0/(lamb + sigmasqr) #diagonal values
+
+        #Q = K_MM + K_NM^T (\Lambda + \sigma^2 I)^-1 K_NM = L_MM A L_MM^T, with A = I + V diag V^T
+        #(better conditioned than Q), so Q^-1 K_NM^T = L_MM^-T A^-1 V
+        A = np.eye(len(K_MM)) + np.dot(V * diag,V.T)
+        invQK_MN = solve_triangular(L_MM,cho_solve(cho_factor(A),V),lower=True,trans='T')
+        return invQK_MN, diag
+
     def draw_prediction_samples(self,Xtest,N=1,Nattempts=7,Nits=1000,verbose=False):
-        GPymean, covar = self.model.predict_noiseless(Xtest)
+        #the posterior mean comes from our own prediction code (which reuses the cached
+        #factorisations), rather than a separate call to GPy's predict_noiseless
         mean, noise, cov = self.draw_noise_samples(Xtest,N,Nattempts,Nits,verbose=verbose)
-        #TODO: In the long run, remove DP4GP's prediction code and just use GPy's
-        #print GPymean-mean
-        #assert np.max(GPymean-mean)<1e-2, "DP4GP code's posterior mean prediction differs from GPy's by %0.5f" % (np.max(GPymean-mean))
         return mean + noise.T, mean, cov
     
 
@@ -91,13 +223,10 @@ class DPGP(object):
             minpred = np.min(mu)
             maxpred = np.max(mu)
             scaledpreds = (70+600*(preds[:,indx]-minpred) / (maxpred-minpred)) / np.sqrt(steps)
-            scalednoise = 1-2.5*DPnoise/(maxpred-minpred) #proportion of data
-            
             #any shade implies the noise is less than 40%(?) of the total change in the signal
-            scalednoise[scalednoise<0] = 0
-            rgba = np.zeros([len(scalednoise),4])
-            rgba[:,0] = 1.0
-            rgba[:,3] = scalednoise
+            rgba = np.ones([len(DPnoise),4]) #red, with the alpha channel set below
+            rgba[:,1:3] = 0
+            rgba[:,3] = np.clip(1-2.5*DPnoise/(maxpred-minpred),0,1) #proportion of data
             plt.scatter(Xtest[:,free_inputs[0]],Xtest[:,free_inputs[1]],scaledpreds,color=rgba)
             
             if plot_data:
@@ -167,19 +296,20 @@ class DPGP_prior(DPGP):
         this the matrix_sensitivity or msense
         * np.max(np.sum(np.abs(A),1))
         """
-        v1 = np.max(np.abs(np.sum(A.copy().clip(min=0),1)))
-        v2 = np.max(np.abs(np.sum((-A.copy()).clip(min=0),1)))
-        return np.max([v1,v2])
+        possums = np.sum(np.maximum(A,0),1)
+        #the row sums of the negative values' magnitudes, without another NxN temporary
+        negsums = possums - np.sum(A,1)
+        return max(np.max(possums),np.max(negsums))
 
     def draw_cov_noise_samples(self,test_cov,msense,N=1):        
         """
         Produce differentially private noise for this covariance matrix
         """
-        G = np.random.multivariate_normal(np.zeros(len(test_cov)),test_cov,N)
-        noise = G*self.sens*np.sqrt(2*np.log(2/self.delta))/self.epsilon
-        noise = noise * msense
-        #print(msense*self.sens*np.sqrt(2*np.log(2/self.delta))/self.epsilon)
-        return np.array(noise), test_cov*(msense*self.sens*np.sqrt(2*np.log(2/self.delta))/self.epsilon)**2
+        G = _draw_mvn_samples(test_cov,N)
+        scale = msense*self._dp_const
+        noise = G*scale
+        #print(scale)
+        return np.array(noise), test_cov*scale**2
 
     def draw_noise_samples(self,Xtest,N=1,Nattempts=7,Nits=1000,verbose=False):
         raise NotImplementedError #need to implemet in a subclass
@@ -192,12 +322,11 @@ class DPGP_normal_prior(DPGP_prior):
         
     def calc_invCov(self):
         """
-        TODO
+        Find (K_NN + sigma^2 I)^-1 from the cached Cholesky factor (calc_msense
+        needs the explicit matrix)
         """
-        sigmasqr = self.model.Gaussian_noise.variance[0]
-        K_NN_diags = self.model.kern.Kdiag(self.model.X)
-        K_NN = self.model.kern.K(self.model.X)
-        invCov = np.linalg.inv(K_NN+sigmasqr*np.eye(K_NN.shape[0]))
+        self.update_cache()
+        invCov = cho_solve(self._L,np.eye(len(self.model.X)))
         self.invCov = invCov
         
     def draw_noise_samples(self,Xtest,N=1,Nattempts=7,Nits=1000,verbose=False):
@@ -208,15 +337,35 @@ class DPGP_normal_prior(DPGP_prior):
         msense = self.calc_msense(self.invCov)
         #print(msense)
         ##This code is only necessary for finding the mean (for testing it matches GPy's)
-        sigmasqr = self.model.Gaussian_noise.variance[0]
-        K_NN = self.model.kern.K(self.model.X)
+        self.update_cache()
         K_Nstar = self.model.kern.K(self.model.X,Xtest)
-        mu = np.dot(np.dot(K_Nstar.T,np.linalg.inv(K_NN+sigmasqr*np.eye(K_NN.shape[0]))),self.model.Y)
+        mu = np.dot(K_Nstar.T,self._alpha)
         ##
         samps, samp_cov = self.draw_cov_noise_samples(test_cov,msense,N)
         return mu, samps, samp_cov
       
     
+class Test_DPGP_normal_prior(object):
+    def test(self):
+        """
+        The cached factorisation must follow changes to the model's training outputs
+        """
+        trainX = np.random.randn(30,1)*5
+        trainy = np.sin(trainX)+np.random.randn(len(trainX),1)*0.5
+        Xtest = np.arange(0,10,2)[:,None]
+
+        mod = GPy.models.GPRegression(trainX,trainy)
+        mod.Gaussian_noise = 0.5**2
+        dpgp = DPGP_normal_prior(mod,2,1.0,0.01)
+        for newy in [trainy, trainy+5, trainy-5]:
+            if newy is not trainy: mod.set_Y(newy)
+            mean, _, _ = dpgp.draw_noise_samples(Xtest)
+            GPymean, _ = mod.predict_noiseless(Xtest)
+            assert np.allclose(mean,GPymean), "Mean not updated after the model's outputs changed"
+        mod.set_XY(trainX,trainy)
+        mean, _, _ = dpgp.draw_noise_samples(Xtest)
+        assert np.allclose(mean,mod.predict_noiseless(Xtest)[0]), "Mean not updated after set_XY"
+
 class DPGP_pseudo_prior(DPGP_prior):
     def draw_noise_samples(self,Xtest,N=1,Nattempts=7,Nits=1000,verbose=False):
         """
@@ -224,37 +373,17 @@ class DPGP_pseudo_prior(DPGP_prior):
         """
         self.model.inference_method = GPy.inference.latent_function_inference.FITC()
         test_cov = self.model.kern.K(Xtest,Xtest)
-        sigmasqr = self.model.Gaussian_noise.variance[0]
-        K_NN_diags = self.model.kern.Kdiag(self.model.X)
-        K_NN = self.model.kern.K(self.model.X)
-        
         K_star = self.model.kern.K(Xtest,self.model.Z.values)
-        K_NM = self.model.kern.K(self.model.X,self.model.Z.values)
-        K_MM = self.model.kern.K(self.model.Z.values)
-        invK_MM = np.linalg.inv(K_MM)
-        
-        #lambda values are the diagonal of the training input covariances minus 
-        #(cov of training+pseudo).(inv cov of pseudo).(transpose of cov of training+pseudo)
-        lamb = np.zeros(len(self.model.X))
-        for i,t_in in enumerate(self.model.X):
-            lamb[i] = K_NN_diags[i] - np.dot(np.dot(K_NM[i,:].T,invK_MM),K_NM[i,:])
-
-        #this finds (\Lambda + \sigma^2 I)^{-1}
-        diag = 1.0/(lamb + sigmasqr) #diagonal values
-
-        #rewritten to be considerably less memory intensive (and make it a little quicker)
-        Q = K_MM + np.dot(K_NM.T * diag,K_NM)
-
-        #find the mean at each test point
-        pseudo_mu = np.dot(     np.dot(np.dot(K_star, np.linalg.inv(Q)),K_NM.T) *  diag  ,self.model.Y)
+        invQK_MN, diag = self.calc_fitc_terms()
 
         #find the covariance
         #K_pseudoInv is the matrix in: mu = k_* K_pseudoInv y
-        #i.e. it does the job of K^-1 for the inducing inputs case
-        K_pseudoInv = np.dot(np.linalg.inv(Q),K_NM.T) * diag
+        #i.e. it does the job of K^-1 for the inducing inputs case.
+        #It equals Q^-1 K_NM^T (\Lambda + \sigma^2 I)^-1, broadcasting diag rather than forming the NxN matrix
+        K_pseudoInv = invQK_MN * diag
 
-        invlambplussigma = np.diag(1.0/(lamb + sigmasqr)) 
-        assert (K_pseudoInv == np.dot(np.dot(np.linalg.inv(Q),K_NM.T),invlambplussigma)).all() #check our optimisation works
+        #find the mean at each test point
+        pseudo_mu = np.dot(K_star,np.dot(K_pseudoInv,self.model.Y))
 
         #find the sensitivity for the pseudo (inducing) inputs
         pseudo_msense = self.calc_msense(K_pseudoInv)
@@ -264,137 +393,138 @@ class DPGP_pseudo_prior(DPGP_prior):
 
 class DPGP_cloaking(DPGP):
     """Using the cloaking method"""
+
+    Mjitter = 1e-10 #added to the diagonal of M, to keep it numerically positive definite
     
     def __init__(self,model,sens,epsilon,delta):      
         super(DPGP_cloaking, self).__init__(model,sens,epsilon,delta)
         assert epsilon<=1, "The proof in Hall et al. 2013 is restricted to values of epsilon<=1."
 
-    def calcM(self,ls,cs):
+    def calcM(self,ls,C):
         """
-        Find the covariance matrix, M, as the lambda weighted sum of c c^T
+        Find the covariance matrix, M, as the lambda weighted sum of c c^T (plus Mjitter
+        on the diagonal). This same M is used to find Delta and as the noise covariance,
+        so the jitter can't loosen the DP guarantee.
         """
-        d = len(cs[0])
-        M = np.zeros([d,d])
-        ccTs = []
-        for l,c in zip(ls,cs):        
-            ccT = np.dot(c,c.T)
-            #print c,ccT,l,M
-            M = M + l*ccT       
-            ccTs.append(ccT)
+        M = np.dot(C*ls,C.T) + self.Mjitter*np.eye(len(C))
         return M
 
-    def L(self,ls,cs):
+    def L(self,ls,C):
         """
         Find L = -log |M| + sum(lambda_i * (1-c^T M^-1 c))
         """
-        M = self.calcM(ls,cs)
-        Minv = np.linalg.pinv(M)
-        t = 0
-        for l,c in zip(ls,cs):        
-            t += l*(1-np.dot(np.dot(c.T,Minv),c))[0,0]
+        M = self.calcM(ls,C)
+        cM = cho_factor(M)
+        cMinvcs = np.sum(C*cho_solve(cM,C),0) #c_i^T M^-1 c_i for every i
+        t = np.sum(ls*(1-cMinvcs))
+        logDetM = 2*np.sum(np.log(np.diag(cM[0])))
 
-        return (np.log(np.linalg.det(Minv)) + t)
+        return (-logDetM + t)
         #return t
         
-    def dL_dl(self,ls,cs):
+    def dL_dl(self,ls,C):
         """
         Find the gradient dL/dl_j
         """
-        M = self.calcM(ls,cs)
-        Minv = np.linalg.pinv(M)            
-        grads = np.zeros(len(ls))    
-        for j in range(len(cs)):        
-            grads[j] = -np.trace(np.dot(Minv,np.dot(cs[j],cs[j].T)))     
-        return np.array(grads)+1
+        M = self.calcM(ls,C)
+        cM = cho_factor(M)
+        #trace(M^-1 c_j c_j^T) = c_j^T M^-1 c_j
+        grads = -np.sum(C*cho_solve(cM,C),0)
+        return grads+1
     
-    def findLambdas_grad(self, cs, maxit=700,verbose=False):
+    def findLambdas_grad(self, C, maxit=700,verbose=False):
         """
         Gradient descent to find the lambda_is
 
         Parameters:
-            cs = list of column vectors (these are the gradients of df*/df_i)
+            C = the cloaking matrix, its columns are the gradients of df*/df_i
 
         Returns:
             ls = vector of lambdas
 
         """
-        #ls = np.ones(len(cs))*0.7
-        ls = 0.1*np.random.rand(len(cs))*0.8 #random numbers between 0.1 and 0.9
+        #ls = np.ones(C.shape[1])*0.7
+        ls = 0.1*np.random.rand(C.shape[1])*0.8 #random numbers between 0.1 and 0.9
         lr = 0.05 #learning rate
-        for it in range(maxit): 
-            lsbefore = ls.copy()
-            delta_ls = -self.dL_dl(ls,cs)*lr
-            ls =  ls + delta_ls
-            ls[ls<0] = 0
-            #lr*=0.995
-            if np.max(np.abs(lsbefore-ls))<1e-5:
-                return ls
-            if verbose: print(".",end='')
-        if verbose: print("Stopped before convergence")
+        #This is deliberately run at double precision: in single precision the larger jitter
+        #needed hides directions in which M is nearly singular, which calcDelta then finds.
+        ls, its, converged = _findLambdas_grad(np.ascontiguousarray(C),ls,lr,maxit,1e-5)
+        if verbose: print("."*its,end='')
+        if verbose and not converged: print("Stopped before convergence")
         return ls
     
-    def findLambdas_scipy(self,cs, maxit=1000, verbose=False):
+    def findLambdas_scipy(self,C, maxit=1000, verbose=False):
         """
         Find optimum value of lambdas, start optimiser with random lambdas.
         """
-        #ls = np.ones(len(cs))*0.7
-        ls = np.random.rand(len(cs))+0.5
-        cons = ({'type':'ineq','fun':lambda ls:np.min(ls)})
+        #ls = np.ones(C.shape[1])*0.7
+        ls = np.random.rand(C.shape[1])+0.5
+        #cons = ({'type':'ineq','fun':lambda ls:np.min(ls)})
         #cons = []
         #for i in range(len(ls)):
         #    cons.append({'type':'ineq', 'fun':lambda ls:ls[i]})
-        res = minimize(self.L, ls, args=(cs), method='SLSQP', options={'ftol': 1e-12, 'disp': True, 'maxiter': maxit}, constraints=cons, jac=self.dL_dl)
+        #bounds (rather than cons) keep SLSQP from stepping to negative lambdas, where M isn't positive definite
+        res = minimize(self.L, ls, args=(C,), method='SLSQP', options={'ftol': 1e-12, 'disp': True, 'maxiter': maxit}, bounds=[(0,None)]*len(ls), jac=self.dL_dl)
         ls = res.x 
         #print ls
         return ls
     
-    def findLambdas_repeat(self,cs,Nattempts=70,Nits=1000, verbose=False):
+    def findLambdas_repeat(self,C,Nattempts=70,Nits=1000, verbose=False, Nstall=3):
         """
-        Call findLambdas repeatedly with different start lambdas, to avoid local minima
+        Call findLambdas repeatedly with different start lambdas, to avoid local minima.
+        Stops early once Nstall attempts in a row fail to improve on the best solution.
         """
         bestLogDetM = np.Inf
         bestls = None
         count = 0      
+        seen = set() #the (rounded) solutions already scored
         while bestls is None: #TODO this keeps going potentially forever!
+            stalled = 0
             for it in range(Nattempts):
                 if verbose: print("*"),
                 import sys
                 sys.stdout.flush()
                 
-                ls = self.findLambdas_grad(cs,Nits,verbose=verbose)
+                ls = self.findLambdas_grad(C,Nits,verbose=verbose)
                 if np.min(ls)<-0.01:
                     continue
-                M = self.calcM(ls,cs)
-                detM = np.linalg.det(M)
-                if detM<=0:
-                    logDetM = -1000 #-np.inf #TODO How do we handle this?
-                else:                    
-                    logDetM = np.log(detM)
-                if logDetM<bestLogDetM:
-                    bestLogDetM = logDetM
-                    bestls = ls.copy()
+                key = ls.round(4).tobytes()
+                if key in seen: #same solution as a previous attempt, no need to score it again
+                    stalled += 1
+                else:
+                    seen.add(key)
+                    M = self.calcM(ls,C)
+                    try:
+                        logDetM = 2*np.sum(np.log(np.diag(cholesky(M,lower=True))))
+                    except np.linalg.LinAlgError: #M isn't positive definite
+                        logDetM = -1000 #-np.inf #TODO How do we handle this?
+                    if logDetM>=bestLogDetM-1e-6:
+                        stalled += 1
+                    else:
+                        stalled = 0
+                    if logDetM<bestLogDetM:
+                        bestLogDetM = logDetM
+                        bestls = ls.copy()
+                if stalled>=Nstall:
+                    break
             count+=1
             if count>1000:
-                raise ValueError('A value for the lambda vector cannot be computed given this cloaking matrix, cs. 1000 attempts have been made at convergence.')
+                raise ValueError('A value for the lambda vector cannot be computed given this cloaking matrix, C. 1000 attempts have been made at convergence.')
         #if bestls is None:
         #    print("Failed to find solution")
         return bestls
     
-    def calcDelta(self,ls,cs):
+    def calcDelta(self,ls,C):
         """
         We want to find a \Delta that satisfies sup{D~D'} ||M^-.5(v_D-v_D')||_2 <= \Delta
         this is equivalent to finding the maximum of our c^T M^-1 c.
         """
-        M = self.calcM(ls,cs)
-        Minv = np.linalg.pinv(M)
-        maxcMinvc = -np.Inf
-        for l,c in zip(ls,cs):
-            cMinvc = np.dot(np.dot(c.transpose(), Minv),c)
-            if cMinvc>maxcMinvc:
-                maxcMinvc = cMinvc
+        M = self.calcM(ls,C)
+        cM = cho_factor(M)
+        maxcMinvc = np.max(np.sum(C*cho_solve(cM,C),0))
         return maxcMinvc
 
-    def checkgrad(self,ls,cs):
+    def checkgrad(self,ls,C):
         """
         Gradient check (test if the analytical derivative dL/dlambda_i almost equals the numerical one)"""
         approx_dL_dl = []
@@ -402,29 +532,27 @@ class DPGP_cloaking(DPGP):
         for i in range(len(ls)):
             delta = np.zeros_like(ls)
             delta[i]+=d
-            approx_dL_dl.append(((self.L(ls+delta,cs)-self.L(ls-delta,cs))/(2*d)))
+            approx_dL_dl.append(((self.L(ls+delta,C)-self.L(ls-delta,C))/(2*d)))
         approx_dL_dl = np.array(approx_dL_dl)
 
         print("Value:")
-        print(self.L(ls,cs))
+        print(self.L(ls,C))
         print("Approx")
         print(approx_dL_dl)
         print("Analytical")
-        print(self.dL_dl(ls,cs))
+        print(self.dL_dl(ls,C))
         print("Difference")
-        print(approx_dL_dl-self.dL_dl(ls,cs))
+        print(approx_dL_dl-self.dL_dl(ls,C))
         print("Ratio")
-        print(approx_dL_dl/self.dL_dl(ls,cs))
+        print(approx_dL_dl/self.dL_dl(ls,C))
 
     def get_C(self,Xtest):
         """
         Compute the value of the cloaking matrix (K_Nstar . K_NN^-1)
         """
-        sigmasqr = self.model.Gaussian_noise.variance[0]
-        K_NN = self.model.kern.K(self.model.X)
-        K_NNinv = np.linalg.inv(K_NN+sigmasqr*np.eye(K_NN.shape[0]))
+        self.update_cache()
         K_Nstar = self.model.kern.K(Xtest,self.model.X)
-        C = np.dot(K_Nstar,K_NNinv)
+        C = cho_solve(self._L,K_Nstar.T).T
         return C
     
     def draw_noise_samples(self,Xtest,N=1,Nattempts=7,Nits=1000,verbose=False):
@@ -434,20 +562,15 @@ class DPGP_cloaking(DPGP):
         #moved computation to seperate method so I can use C for other things
         C = self.get_C(Xtest)
 
-        cs = []
-        for i in range(C.shape[1]):
-            cs.append(C[:,i][:,None])
+        ls = self.findLambdas_repeat(C,Nattempts,Nits,verbose=verbose)
+        M = self.calcM(ls,C)
         
-        ls = self.findLambdas_repeat(cs,Nattempts,Nits,verbose=verbose)
-        M = self.calcM(ls,cs)
-        
-        c = np.sqrt(2*np.log(2/self.delta))
-        Delta = self.calcDelta(ls,cs)
+        Delta = self.calcDelta(ls,C)
         #in Hall13 the constant below is multiplied by the samples,
         #here we scale the covariance by the square of this constant.
-        #if verbose: print(self.sens,c,Delta,self.epsilon,np.linalg.det(M))
-        sampcov = ((self.sens*c*Delta/self.epsilon)**2)*M
-        samps = np.random.multivariate_normal(np.zeros(len(sampcov)),sampcov,N)
+        #if verbose: print(self._dp_const,Delta,np.linalg.det(M))
+        sampcov = ((self._dp_const*Delta)**2)*M
+        samps = _draw_mvn_samples(sampcov,N)
         
         ###This code is only necessary for finding the mean
         mu = np.dot(C,self.model.Y)
@@ -472,36 +595,67 @@ class Test_DPGP_cloaking(object):
 
         largest_notDP = -np.Inf
         #dpgp, noise, sampcov = get_noise(trainX,trainy,Xtest,sens,eps,delta)
+        #the posterior mean is C y, so perturbing y_i by sens just adds sens*C[:,i]
+        #to it (the hyperparameters, and so C and sampcov, don't depend on y).
+        #C is found from GPy's posterior, independently of dpgp.get_C.
+        C = np.dot(mod.kern.K(Xtest,trainX),mod.posterior.woodbury_inv)
+        muA, _ = mod.predict_noiseless(Xtest)
+        assert np.allclose(np.dot(C,trainy),muA)
+        #with sampcov = LL^T and x = muA + Lz, the log of N(x|muA)/N(x|muB) is 0.5||d||^2 - z.d,
+        #where d = L^-1 (muB-muA), so samples only need drawing in this whitened space.
+        L = cholesky(sampcov,lower=True)
+        N = 200000
         for perturb_index in range(50): 
-            mod = GPy.models.GPRegression(trainX,trainy)
-            mod.Gaussian_noise = 0.5**2
-            mod.rbf.lengthscale = 1.0
-            dpgp = DPGP_cloaking(mod,sens,eps,delta)
-            muA, _ = dpgp.model.predict_noiseless(Xtest)
-            pert_trainy = np.copy(trainy)
-            pert_trainy[perturb_index]+=sens
-            mod = GPy.models.GPRegression(trainX,pert_trainy)
-            mod.Gaussian_noise = 0.5**2
-            mod.rbf.lengthscale = 1.0
-            dpgp = DPGP_cloaking(mod,sens,eps,delta)
-            muB, _ = dpgp.model.predict_noiseless(Xtest)
-
-
-            dist = multivariate_normal(muA[:,0],sampcov)
-            dist_shift = multivariate_normal(muB[:,0],sampcov)
-            N = 200000
+            d = solve_triangular(L,sens*C[:,perturb_index],lower=True)
+            halfdd = 0.5*np.dot(d,d)
             #print("These two numbers should be less than delta=%0.4f" % dpgp.delta)
             #print("Note epsilon = %0.4f" % dpgp.epsilon)
-            pos = np.random.multivariate_normal(muA[:,0],sampcov,N)
-            proportion_notDP_A = np.mean( (dist.pdf(pos)/dist_shift.pdf(pos))>np.exp(dpgp.epsilon) )
-            pos = np.random.multivariate_normal(muB[:,0],sampcov,N)
-            proportion_notDP_B = np.mean( (dist_shift.pdf(pos)/dist.pdf(pos))>np.exp(dpgp.epsilon) )
+            z = np.random.standard_normal((N,len(d))) #samples from N(muA,sampcov), whitened about muA
+            proportion_notDP_A = np.mean( (halfdd-np.dot(z,d))>dpgp.epsilon )
+            z = np.random.standard_normal((N,len(d))) #samples from N(muB,sampcov), whitened about muB
+            proportion_notDP_B = np.mean( (halfdd+np.dot(z,d))>dpgp.epsilon )
             assert proportion_notDP_A < dpgp.delta
             assert proportion_notDP_B < dpgp.delta
 
             largest_notDP = np.max([largest_notDP,proportion_notDP_A,proportion_notDP_B])
         print("The largest proportion of values exceeding the epsilon-DP constraint is %0.6f. This should be less than delta, which equals %0.6f" % (largest_notDP, dpgp.delta))
         
+class Test_DPGP_sparse(object):
+    def test(self):
+        """
+        The FITC cloaking matrix, and the pseudo-prior's K_pseudoInv, should match the
+        dense formula K_star Q^-1 K_NM^T (\Lambda + \sigma^2 I)^-1, also after the
+        inducing inputs and noise variance have been changed
+        """
+        trainX = np.random.randn(50,1)*5
+        trainy = np.sin(trainX)+np.random.randn(len(trainX),1)*0.5
+        Xtest = np.arange(0,10,2)[:,None]
+
+        mod = GPy.models.SparseGPRegression(trainX,trainy,num_inducing=6)
+        cloaking = DPGP_inducing_cloaking(mod,2,1.0,0.01)
+        pseudo = DPGP_pseudo_prior(mod,2,1.0,0.01)
+        for it in range(4):
+            if it==1: mod.Z[:] = np.linspace(-8,8,6)[:,None]
+            if it>=2: mod.Gaussian_noise.variance = [0.25,0.3][it%2]
+
+            Z = np.array(mod.Z.values)
+            sigmasqr = mod.Gaussian_noise.variance[0]
+            K_star = mod.kern.K(Xtest,Z)
+            K_NM = mod.kern.K(trainX,Z)
+            K_MM = mod.kern.K(Z)
+            lamb = mod.kern.Kdiag(trainX) - np.sum(K_NM*np.linalg.solve(K_MM,K_NM.T).T,1)
+            diag = 1.0/(lamb + sigmasqr)
+            Q = K_MM + np.dot(K_NM.T*diag,K_NM)
+            K_pseudoInv = np.linalg.solve(Q,K_NM.T)*diag
+
+            assert np.allclose(cloaking.get_C(Xtest),np.dot(K_star,K_pseudoInv))
+            invQK_MN, fitcdiag = pseudo.calc_fitc_terms()
+            assert np.allclose(invQK_MN*fitcdiag,K_pseudoInv)
+            mu, _, samp_cov = pseudo.draw_noise_samples(Xtest)
+            assert np.allclose(mu,np.dot(K_star,np.dot(K_pseudoInv,trainy)))
+            msense = pseudo.calc_msense(K_pseudoInv)
+            assert np.allclose(samp_cov,mod.kern.K(Xtest)*(msense*pseudo._dp_const)**2)
+
 class DPGP_inducing_cloaking(DPGP_cloaking):
     """Using Cloaking and Inducing inputs
     
@@ -523,28 +677,9 @@ class DPGP_inducing_cloaking(DPGP_cloaking):
         Compute the value of the cloaking matrix, overrides DPGP and uses inducing inputs
         """
 
-        test_cov = self.model.kern.K(Xtest,Xtest)
-        sigmasqr = self.model.Gaussian_noise.variance[0]
-        K_NN_diags = self.model.kern.Kdiag(self.model.X)
-        K_NN = self.model.kern.K(self.model.X)
-        
         K_star = self.model.kern.K(Xtest,self.model.Z.values)
-        #print(self.model.Z.values)
-        K_NM = self.model.kern.K(self.model.X,self.model.Z.values)
-        K_MM = self.model.kern.K(self.model.Z.values)
-        invK_MM = np.linalg.inv(K_MM)
-        
-        #lambda values are the diagonal of the training input covariances minus 
-        #(cov of training+pseudo).(inv cov of pseudo).(transpose of cov of training+pseudo)
-        lamb = np.zeros(len(self.model.X))
-        for i,t_in in enumerate(self.model.X):
-            lamb[i] = K_NN_diags[i] - np.dot(np.dot(K_NM[i,:].T,invK_MM),K_NM[i,:])
-
-        #this finds (\Lambda + \sigma^2 I)^{-1}
-        diag = 1.0/(lamb + sigmasqr) #diagonal values
-
-        Q = K_MM + np.dot(K_NM.T * diag,K_NM)
-        C = np.dot(np.dot(K_star, np.linalg.inv(Q)),K_NM.T) *  diag
+        invQK_MN, diag = self.calc_fitc_terms()
+        C = np.dot(K_star,invQK_MN) *  diag
         return C
     
 